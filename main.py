@@ -1,133 +1,184 @@
 import csv
+import io
 import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from tkinter.filedialog import askopenfilename
 
 import chardet
+import numpy as np
 import pandas as pd
 
+# Matches the start of the first line that meets both header requirements:
+# 1. Either "name" or ("firstname" and "lastname"), both of which contain "name"
+# 2. One of "dob", "date of birth", or "birthdate"
+HEADER_LINE = re.compile(
+    r"(?:^|(?<=\r))(?=[^\r\n]*name)(?=[^\r\n]*(?:dob|date of birth|birthdate))",
+    re.IGNORECASE | re.MULTILINE,
+)
+LINE_BREAK = re.compile(r"\r\n|\r|\n")
+NAME_FIELDS = ("name", "firstname", "lastname")
+DOB_FIELDS = ("birthdate", "date of birth", "dob")
+DELIMITERS = (",", "\t", ";")
+SUFFIXES = frozenset(
+    ["jr", "sr", "ii", "iii", "iv", "v", "vi", "vii", "viii", "ix", "x"]
+)
+
 
 def standardize_dob(df, dob_field):
-    """Standardize the date of birth field to 'YYYY-MM-DD' format."""
-    df["helper_dob"] = pd.to_datetime(df[dob_field], errors="coerce").dt.strftime(
-        "%Y-%m-%d"
-    )
+    """Standardize the date of birth field to a date-only datetime64 column."""
+    df["helper_dob"] = pd.to_datetime(
+        df[dob_field], errors="coerce", cache=True
+    ).dt.normalize()
     return df
 
 
-def detect_encoding(filepath):
+def standardize_names(df):
+    """Split the name fields into helper_firstname and helper_lastname."""
+    if "name" in df.columns:
+        df["helper_firstname"] = df["name"].str.split().str[0]
+        df["helper_lastname"] = handle_suffix_lastnames(df["name"])
+    if "lastname" in df.columns:
+        df["helper_lastname"] = handle_suffix_lastnames(df["lastname"])
+    if "firstname" in df.columns:
+        df["helper_firstname"] = df["firstname"].str.split().str[0]
+    return df[[c for c in df.columns if c != "name"]].copy()
+
+
+def read_sample(filepath, sample_size=65536):
+    """Read the first `sample_size` bytes of a file for format detection."""
     with open(filepath, "rb") as f:
-        rawdata = f.read()
-        result = chardet.detect(rawdata)
-        return result["encoding"]
+        return f.read(sample_size)
+
+
+def detect_encoding(rawdata):
+    """Detect the encoding of a byte sample, defaulting to UTF-8."""
+    result = chardet.detect(rawdata)
+    return result["encoding"] or "utf-8"
 
 
-def detect_delimiter(filepath, encoding, sample_size=1024, num_lines_fallback=10):
+def detect_delimiter(sample, sample_size=1024, num_lines_fallback=10):
+    # Counting the candidate delimiters is much cheaper than csv.Sniffer, which
+    # scans every ASCII character per line; only sniff when the counts are close.
+    counts = sorted((sample.count(d), d) for d in DELIMITERS)
+    (runner_up, _), (top, best) = counts[-2:]
+    if top > 0 and runner_up < top * 0.9:
+        return best
+
     try:
-        with open(filepath, "r", encoding=encoding) as f:
-            sample = f.read(sample_size)
-            sniffer = csv.Sniffer()
-            delimiter = sniffer.sniff(sample).delimiter
-            return delimiter
+        sniffer = csv.Sniffer()
+        delimiter = sniffer.sniff(sample[:sample_size]).delimiter
+        return delimiter
     except Exception as e:
         logging.warning(f"Sniffer failed: {e}. Falling back to frequency analysis.")
-        return analyze_most_common_delimiter(filepath, num_lines_fallback)
+        return analyze_most_common_delimiter(sample, num_lines_fallback)
 
 
-def analyze_most_common_delimiter(filepath, num_lines=10):
-    delimiter_counts = {}
+def analyze_most_common_delimiter(sample, num_lines=10):
     try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            for i, line in enumerate(f):
-                if i >= num_lines:
-                    break
-                for char in line:
-                    if char not in delimiter_counts:
-                        delimiter_counts[char] = 0
-                    delimiter_counts[char] += 1
-
-        if not delimiter_counts:
-            return None
-
-        sorted_delimiters = sorted(
-            delimiter_counts.items(), key=lambda item: item[1], reverse=True
-        )
-
-        potential_delimiters = [
-            item[0]
-            for item in sorted_delimiters
-            if item[0] in [",", "\t", ";"] and item[1] > 0
-        ]
-
-        if potential_delimiters:
-            return potential_delimiters[0]
-        else:
-            return None
+        head = "".join(islice(io.StringIO(sample, newline=None), num_lines))
+        counts = {d: head.count(d) for d in DELIMITERS}
+        best = max(counts, key=counts.get)
+        return best if counts[best] > 0 else None
 
     except Exception as e:
         logging.error(f"Delimiter frequency analysis failed: {e}")
         return None
 
 
-def find_header_start(filepath, encoding):
+def find_header_start(sample):
     """
     Finds the starting line of the header based on the presence of ANY of the keywords.
 
     Args:
-        filepath (str): The path to the file.
-        header_keywords (list): A list of strings that, if ANY are present, indicate a header line.
+        sample (str): The decoded beginning of the file.
 
     Returns:
         int: The line number (0-based) where the header starts, or None if not found.
     """
     try:
-        with open(filepath, "r", encoding=encoding) as f:
-            for i, line in enumerate(f):
-                line_lower = line.lower()
-
-                # Requirement 1: Either "name" or ("firstname" and "lastname")
-                has_name = "name" in line_lower
-                has_firstname = "firstname" in line_lower
-                has_lastname = "lastname" in line_lower
-                name_condition = has_name or (has_firstname and has_lastname)
-
-                # Requirement 2: One of "dob", "date of birth", or "birthdate"
-                has_dob = "dob" in line_lower
-                has_date_of_birth = "date of birth" in line_lower
-                has_birthdate = "birthdate" in line_lower
-                dob_condition = has_dob or has_date_of_birth or has_birthdate
-
-                if name_condition and dob_condition:
-                    return i
-        return None  # Header not found
-    except FileNotFoundError:
-        logging.error(f"File not found: {filepath}")
-        return None
+        match = HEADER_LINE.search(sample)
+        if match is None:
+            return None  # Header not found
+        return len(LINE_BREAK.findall(sample, 0, match.start()))
     except Exception as e:
         logging.error(f"Error finding header: {e}")
         return None
 
 
 def find_dob_field(df):
-    for field in ["birthdate", "date of birth", "dob"]:
+    for field in DOB_FIELDS:
         if field in df.columns:
             return field
     return None
 
 
-def read_csv_with_detections(filepath):
-    encoding = detect_encoding(filepath)
-    header_start = find_header_start(filepath, encoding)
-    delimiter = detect_delimiter(filepath, encoding)
+def read_header(sample, header_start, delimiter):
+    """Return the column names on the header line of the sample."""
+    lines = islice(io.StringIO(sample, newline=None), header_start, None)
+    return next(csv.reader(lines, delimiter=delimiter or ","), [])
+
+
+def read_csv_with_detections(filepath, fields=None):
+    """
+    Reads a CSV after detecting its encoding, delimiter and header line.
+
+    Args:
+        filepath (str): The path to the file.
+        fields (iterable): Lowercase column names to read. All columns are read
+            if this is None or none of them are found in the header.
+
+    Returns:
+        DataFrame: The file contents with lowercased column names, or None on error.
+    """
+    try:
+        rawdata = read_sample(filepath)
+    except FileNotFoundError:
+        logging.error(f"File not found: {filepath}")
+        return None
+
+    encoding = detect_encoding(rawdata)
+    sample = rawdata.decode(encoding, errors="replace")
+    # An ASCII sample says nothing about the rest of the file, so read it with
+    # a superset: UTF-8 first, then Windows-1252, which older exports use
+    encodings = [encoding]
+    if encoding.lower() == "ascii":
+        encodings = ["utf-8", "cp1252"]
+    header_start = find_header_start(sample)
+    delimiter = detect_delimiter(sample)
 
     if header_start is not None:
-        try:
-            df = pd.read_csv(
-                filepath, encoding=encoding, delimiter=delimiter, skiprows=header_start
-            ).rename(columns=str.lower)
-            return df
-        except Exception as e:
-            logging.error(f"Error reading CSV: {e}")
-            return None
+        header = read_header(sample, header_start, delimiter)
+        usecols = None
+        if fields is not None:
+            usecols = [column for column in header if column.lower() in fields]
+        # Read the name and DOB columns as strings up front rather than letting
+        # them be inferred and converted afterwards
+        dtype = {
+            column: "string"
+            for column in usecols or header
+            if column.lower() in NAME_FIELDS + DOB_FIELDS
+        }
+        for encoding in encodings:
+            try:
+                df = pd.read_csv(
+                    filepath,
+                    encoding=encoding,
+                    delimiter=delimiter,
+                    skiprows=header_start,
+                    usecols=usecols or None,
+                    dtype=dtype,
+                ).rename(columns=str.lower)
+                break
+            except UnicodeDecodeError as e:
+                if encoding == encodings[-1]:
+                    logging.error(f"Error reading CSV: {e}")
+                    return None
+            except Exception as e:
+                logging.error(f"Error reading CSV: {e}")
+                return None
+        return df
     else:
         logging.error(f"Header line not found in {filepath} based on keywords.")
         return None
@@ -142,52 +193,63 @@ def pick_file(title, initialfile):
     return filepath
 
 
+def read_roster(filepath, fields=None):
+    """
+    Reads a student roster and adds the helper columns used for matching.
+
+    Args:
+        filepath (str): The path to the file.
+        fields (iterable): Lowercase column names to read, or None for all.
+
+    Returns:
+        DataFrame: The roster with helper_firstname, helper_lastname and
+            helper_dob columns, or None if the file could not be read.
+    """
+    df = read_csv_with_detections(filepath, fields)
+    if df is None:
+        return None
+
+    df = standardize_dob(df, find_dob_field(df))
+    return standardize_names(df)
+
+
 def find_changed_students(filter_sped, all_sped):
-    filter_df = read_csv_with_detections(filter_sped)
-    all_df = read_csv_with_detections(all_sped)
+    # The two reads are independent and mostly spent in I/O and pandas' native
+    # parser, so they can overlap
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        filter_future = executor.submit(read_roster, filter_sped)
+        # Only the name and DOB columns of the SpEd export are used; the
+        # filtered file is written back out, so it keeps all of its columns
+        all_future = executor.submit(read_roster, all_sped, NAME_FIELDS + DOB_FIELDS)
+        filter_df, all_df = filter_future.result(), all_future.result()
 
     if filter_df is None or all_df is None:
         return None
 
-    dob_field_filtered = find_dob_field(filter_df)
-    dob_field_all = find_dob_field(all_df)
-
-    filter_df = standardize_dob(filter_df, dob_field_filtered)
-    all_df = standardize_dob(all_df, dob_field_all)
-
-    for df in [filter_df, all_df]:
-        if "name" in df.columns:
-            df["helper_firstname"] = df["name"].apply(
-                lambda x: x.split()[0] if isinstance(x, str) and x.split() else None
-            )
-            df["helper_lastname"] = df["name"].apply(
-                lambda x: handle_suffix_lastname(x) if isinstance(x, str) else None
-            )
-            df.drop(columns=["name"], inplace=True)
-        if "lastname" in df.columns:
-            df["helper_lastname"] = df["lastname"].apply(
-                lambda x: handle_suffix_lastname(x) if isinstance(x, str) else None
-            )
-        if "firstname" in df.columns:
-            df["helper_firstname"] = df["firstname"].apply(
-                lambda x: x.split()[0] if isinstance(x, str) and x.split() else None
-            )
-
-    for index, row in filter_df.iterrows():
-        if all_df[
-            (all_df["helper_lastname"] == row["helper_lastname"])
-            & (all_df["helper_firstname"] == row["helper_firstname"])
-            & (all_df["helper_dob"] == row["helper_dob"])
-        ].any(axis=None):
-            filter_df.loc[index, "isspecialed"] = True
-        else:
-            filter_df.loc[index, "isspecialed"] = False
-
-    filter_df.drop(
-        columns=["helper_lastname", "helper_firstname", "helper_dob"], inplace=True
+    key_cols = ["helper_lastname", "helper_firstname", "helper_dob"]
+    # merge() pairs missing keys with each other, so drop them from the lookup
+    # side; rows with a blank name or unparseable DOB never count as a match
+    all_keys = all_df[key_cols].dropna().drop_duplicates()
+    # Sharing one set of categories lets the merge hash integer codes rather
+    # than strings; the categories cover both sides so no name falls outside
+    name_dtypes = {
+        col: pd.CategoricalDtype(
+            pd.concat([all_keys[col], filter_df[col]]).dropna().unique()
+        )
+        for col in ["helper_lastname", "helper_firstname"]
+    }
+    all_keys = all_keys.astype(name_dtypes)
+    merged = filter_df[key_cols].astype(name_dtypes).merge(
+        all_keys,
+        on=key_cols,
+        how="left",
+        sort=False,
+        indicator=True,
+        validate="m:1",
     )
+    filter_df["isspecialed"] = merged["_merge"].eq("both").to_numpy(dtype=bool)
 
-    return filter_df
+    return filter_df[[c for c in filter_df.columns if c not in key_cols]].copy()
 
 
 def handle_suffix_lastname(name_str):
@@ -195,12 +257,22 @@ def handle_suffix_lastname(name_str):
     if not parts:
         return None
 
-    last_part = parts[-1].lower()
-    roman_numerals = ["ii", "iii", "iv", "v", "vi", "vii", "viii", "ix", "x"]
-    if last_part in ["jr", "sr"] + roman_numerals and len(parts) > 1:
-        return " ".join(parts[-2:])  # Combine the last two parts
-    else:
-        return parts[-1]  # Return the last part as is
+    if len(parts) > 1 and parts[-1].lower() in SUFFIXES:
+        return parts[-2] + " " + parts[-1]  # Combine the last two parts
+    return parts[-1]  # Return the last part as is
+
+
+def handle_suffix_lastnames(names):
+    """Vectorized handle_suffix_lastname over a Series of name strings."""
+    parts = names.str.split()
+    # Cast back to string: when no name has the token, .str[] yields all-NaN floats
+    last = parts.str[-1].astype("string")
+    prev = parts.str[-2].astype("string")
+    is_suffix = last.str.lower().isin(SUFFIXES) & (parts.str.len() > 1)
+    return pd.Series(
+        np.where(is_suffix, prev + " " + last, last),
+        index=names.index,
+    )
 
 
 if __name__ == "__main__":